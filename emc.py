@@ -5,6 +5,7 @@
 import sys
 import os
 import argparse
+import ctypes
 import configparser
 import time
 
@@ -12,10 +13,18 @@ import numpy as np
 import h5py
 from mpi4py import MPI
 import cupy as cp
+import cupyx
 
 import kernels
 P_MIN = 1.e-6
 MEM_THRESH = 0.8
+MAX_BATCH = 16
+
+def zero_async(arr, stream=None):
+    '''Zero contiguous device array with a memset queued on stream (default: current)'''
+    if stream is None:
+        stream = cp.cuda.get_current_stream()
+    cp.cuda.runtime.memsetAsync(arr.data.ptr, 0, arr.nbytes, stream.ptr)
 
 class Dataset():
     '''Parses sparse photons dataset from HDF5 file
@@ -54,22 +63,26 @@ class Dataset():
                                        for i in range(self.num_data)]).astype('i4')
             self.multi_accum = cp.roll(self.multi.cumsum(), 1)
             self.multi_accum[0] = 0
-            self.place_multi = cp.array(np.hstack(fptr['place_multi'][:]))
+            place_multi = np.hstack(fptr['place_multi'][:])
             self.count_multi = np.hstack(fptr['count_multi'][:])
 
             self.mean_count = float((self.place_ones.shape[0] +
                                      self.count_multi.sum()
                                     ) / self.num_data)
+            # Interleaved (place, count) pairs so that one 8-byte load fetches both
+            self.pc_multi = cp.array(np.stack((place_multi, self.count_multi), axis=1).astype('i4'))
+            self.place_multi = self.pc_multi[:, 0]
+            self.count_multi = self.pc_multi[:, 1]
             if need_scaling:
-                self.counts = self.ones + cp.array([self.count_multi[m_a:m_a+m].sum()
-                                                    for m, m_a in zip(self.multi.get(), self.multi_accum.get())])
-            self.count_multi = cp.array(self.count_multi)
+                # Per-frame multi-photon totals from differences of the running sum
+                csum = cp.concatenate((cp.zeros(1, dtype='i8'), self.count_multi.cumsum(dtype='i8')))
+                self.counts = self.ones + csum[self.multi_accum + self.multi] - csum[self.multi_accum]
 
             try:
-                self.bg = cp.array(fptr['bg'][:]).ravel()
+                self.bg = cp.array(fptr['bg'][:]).ravel().astype('f4')
                 print('Using background model with %.2f photons/frame' % self.bg.sum())
             except KeyError:
-                self.bg = cp.zeros(self.num_pix)
+                self.bg = cp.zeros(self.num_pix, dtype='f4')
         self.mem = mpool.used_bytes() - init_mem
 
 class EMC():
@@ -77,12 +90,15 @@ class EMC():
 
     Args:
         config_file (str): Path to configuration file
+        num_streams (int, optional): Number of CUDA streams to distribute rotations over
+        cuda_aware (bool, optional): Whether MPI can reduce GPU buffers directly
 
     The appropriate CUDA device must be selected before initializing the class.
     Can be used with mpirun, in which case work will be divided among ranks.
     '''
-    def __init__(self, config_file, num_streams=4):
+    def __init__(self, config_file, num_streams=4, cuda_aware=False):
         self.num_streams = num_streams
+        self.cuda_aware = cuda_aware
         self.comm = MPI.COMM_WORLD
         self.rank = self.comm.rank
         self.num_proc = self.comm.size
@@ -109,20 +125,58 @@ class EMC():
             print('%d frames with %.3f photons/frame (%.3f s) (%.2f MB)' % \
                     (self.dset.num_data, self.dset.mean_count, etime-stime, self.dset.mem/1024**2))
             sys.stdout.flush()
-        self.model = np.empty((self.size, self.size))
+        # Host copies are pinned so that transfers around MPI calls avoid staging copies
+        self.model = cupyx.empty_pinned((self.size, self.size), dtype='f8')
         if self.rank == 0:
             self.model[:] = np.random.random((self.size,)*2) * self.dset.mean_count / self.dset.num_pix
         self.comm.Bcast([self.model, MPI.DOUBLE], root=0)
-        self.mweights = np.zeros((self.size, self.size), dtype='f8')
+        self.mweights = cupyx.zeros_pinned((self.size, self.size), dtype='f8')
+        # Device copies persist between iterations. The current model is only read
+        # while the merged model and weights accumulate in separate arrays
+        self.dmodel = cp.array(self.model)
+        self.dmodel_acc = cp.zeros_like(self.dmodel)
+        self.dmweights = cp.zeros_like(self.dmodel)
         if self.need_scaling:
             self.scales = self.dset.counts / self.dset.mean_count
         else:
             self.scales = cp.ones(self.dset.num_data, dtype='f8')
         self.prob = cp.array([])
 
-        self.bsize_model = int(np.ceil(self.size/32.))
-        self.bsize_data = int(np.ceil(self.dset.num_data/32.))
-        self.stream_list = [cp.cuda.Stream() for _ in range(self.num_streams)]
+        # Rotation matrices (row-major 2x2) so that kernels avoid per-pixel trigonometry
+        angles = np.arange(self.rank, self.num_rot, self.num_proc) / self.num_rot * 2. * np.pi
+        self.rots = cp.array(np.stack((np.cos(angles), -np.sin(angles),
+                                       np.sin(angles), np.cos(angles)), axis=1))
+        self.num_rot_p = self.rots.shape[0]
+        self.p_norm = cp.empty(self.num_rot_p, dtype='f8')
+
+        # Slice kernels specialized to the model size. All kernels are compiled here rather
+        # than on first launch, which may be inside a CUDA graph capture
+        self.slice_gen = kernels.specialize(kernels.slice_gen, self.size)
+        self.slice_merge = kernels.specialize(kernels.slice_merge, self.size)
+        for kernel in (self.slice_gen, self.slice_merge, kernels.calc_prob_all,
+                       kernels.merge_all, kernels.prob_stats, kernels.prob_norm):
+            kernel.compile()
+
+        self.bsize_model = int(np.ceil(self.size/16.))
+        self.bsize_data = int(np.ceil(self.dset.num_data/8.))
+        # Non-blocking streams do not serialize with the null stream. Ordering is explicit
+        # through _fork_streams() and _join_streams()
+        self.stream_list = [cp.cuda.Stream(non_blocking=True) for _ in range(self.num_streams)]
+        # Contiguous range of local rotations handled by each stream, launched in batches
+        # of at most max_batch rotations. Each stream reuses its own max_batch views
+        chunk = int(np.ceil(self.num_rot_p / self.num_streams))
+        self.max_batch = min(chunk, MAX_BATCH)
+        self.rot_batches = [[(b, min(b + self.max_batch, r + chunk, self.num_rot_p))
+                             for b in range(r, min(r + chunk, self.num_rot_p), self.max_batch)]
+                            for r in range(0, self.num_rot_p, chunk)]
+        self.views = cp.empty((len(self.rot_batches) * self.max_batch, self.size**2), dtype='f4')
+        self.events = [cp.cuda.Event(disable_timing=True) for _ in range(self.num_streams)]
+        self.fork_event = cp.cuda.Event(disable_timing=True)
+        self.copy_stream = cp.cuda.Stream(non_blocking=True)
+        self.copy_event = cp.cuda.Event(disable_timing=True)
+        self.msum = cp.empty(1, dtype='f8')
+        self.graphs = {}
+        self.pinned = {}
 
     def run_iteration(self, iternum=None):
         '''Run one iterations of EMc algorithm
@@ -130,121 +184,230 @@ class EMC():
         Args:
             iternum (int, optional): If specified, output is tagged with iteration number
 
-        Current guess is assumed to be in self.model, which is updated. If scaling is included,
-        the scale factors are in self.scales.
+        Current guess is assumed to be in self.dmodel, which is updated. The host copy in
+        self.model is refreshed on all ranks, or only on rank 0 with CUDA-aware MPI. If scaling
+        is included, the scale factors are in self.scales.
         '''
 
-        num_rot_p = self.num_rot // self.num_proc
-        if self.rank < self.num_rot % self.num_proc:
-            num_rot_p += 1
-        mem_frac = num_rot_p*self.dset.num_data*8/ (self.mem_size - self.dset.mem)
+        num_rot_p = self.num_rot_p
+        mem_frac = num_rot_p*self.dset.num_data*4/ (self.mem_size - self.dset.mem - self.views.nbytes)
         num_blocks = int(np.ceil(mem_frac / MEM_THRESH))
         block_sizes = np.array([self.dset.num_data // num_blocks] * num_blocks)
         block_sizes[0:self.dset.num_data % num_blocks] += 1
         #if len(block_sizes) > 1: print(block_sizes, 'frames in each block')
 
         if self.prob.shape != (num_rot_p, block_sizes.max()):
-            self.prob = cp.empty((num_rot_p, block_sizes.max()), dtype='f8')
-        views = cp.empty((self.num_streams, self.size**2), dtype='f8')
-        dmodel = cp.array(self.model)
-        dmweights = cp.array(self.mweights)
+            self.prob = cp.empty((num_rot_p, block_sizes.max()), dtype='f4')
+        views = self.views
+        zero_async(self.dmodel_acc)
+        zero_async(self.dmweights)
+        self.msum[:] = -self.dmodel.sum()
         #mp = cp.get_default_memory_pool()
         #print('Mem usage: %.2f MB / %.2f MB' % (mp.total_bytes()/1024**2, self.mem_size/1024**2))
 
         b_start = 0
         for b in block_sizes:
             drange = (b_start, b_start + b)
-            self._calculate_prob(dmodel, views, drange)
+            self._calculate_prob(views, drange)
             self._normalize_prob()
-            self._update_model(views, dmodel, dmweights, drange)
+            self._update_model(views, drange)
             b_start += b
-        self._normalize_model(dmodel, dmweights, iternum)
+        self._normalize_model(iternum)
+
+    def _calculate_prob(self, views, drange):
+        self.bsize_data = int(np.ceil((drange[1] - drange[0])/8.))
+        # Every buffer baked into the graph is part of the key, so rebinding any of them
+        # (e.g. a new self.dmodel or self.scales) invalidates the cached graphs
+        dset = self.dset
+        key = (drange, self.prob.shape) + tuple(arr.data.ptr for arr in (
+                views, self.prob, self.dmodel, self.scales, self.msum, self.rots,
+                dset.bg, dset.ones, dset.multi, dset.ones_accum, dset.multi_accum,
+                dset.place_ones, dset.pc_multi))
+        self._fork_streams()
+        if key not in self.graphs:
+            # Discard graphs holding stale buffer pointers and run eagerly the first time
+            self.graphs = {k: g for k, g in self.graphs.items() if k[1:] == key[1:]}
+            self.graphs[key] = None
+            self._launch_prob(views, drange)
+        else:
+            if self.graphs[key] is None:
+                self.graphs[key] = self._capture(self._launch_prob, views, drange)
+            self.graphs[key].launch(self.stream_list[0])
+        self._join_streams()
 
-    def _calculate_prob(self, dmodel, views, drange):
-        msum = float(-self.model.sum())
+    def _launch_prob(self, views, drange):
         s = drange[0]
         e = drange[1]
         num_data_b = e - s
-        self.bsize_data = int(np.ceil(num_data_b/32.))
 
-        for i, r in enumerate(range(self.rank, self.num_rot, self.num_proc)):
-            snum = i % self.num_streams
+        for snum, batches in enumerate(self.rot_batches):
             self.stream_list[snum].use()
-            kernels.slice_gen((self.bsize_model,)*2, (32,)*2,
-                    (dmodel, r/self.num_rot*2.*np.pi, 1.,
-                     self.size, self.dset.bg, 1, views[snum]))
-            kernels.calc_prob_all((self.bsize_data,), (32,),
-                    (views[snum], num_data_b,
-                     self.dset.ones[s:e], self.dset.multi[s:e],
-                     self.dset.ones_accum[s:e], self.dset.multi_accum[s:e],
-                     self.dset.place_ones, self.dset.place_multi, self.dset.count_multi,
-                     msum, self.scales[s:e], self.prob[i]))
-        [s.synchronize() for s in self.stream_list]
-        cp.cuda.Stream().null.use()
+            for r_s, r_e in batches:
+                view = self._stream_views(views, snum, r_e - r_s)
+                self.slice_gen((self.bsize_model, self.bsize_model, r_e - r_s), (16,)*2,
+                        (self.dmodel, self.rots[r_s:r_e], 1.,
+                         self.size, self.dset.bg, 1, view))
+                kernels.calc_prob_all((self.bsize_data, 1, r_e - r_s), (32, 8),
+                        (view, self.size**2, num_data_b,
+                         self.dset.ones[s:e], self.dset.multi[s:e],
+                         self.dset.ones_accum[s:e], self.dset.multi_accum[s:e],
+                         self.dset.place_ones, self.dset.pc_multi,
+                         self.msum, self.scales[s:e], self.prob.shape[1], self.prob[r_s:r_e]))
+
+    def _capture(self, func, *args):
+        '''Capture kernels launched by func on the worker streams into a CUDA graph
+
+        All kernel arguments are baked into the graph, so func must not allocate memory
+        or pass values which change between launches.
+        '''
+        origin = self.stream_list[0]
+        origin.begin_capture()
+        self.events[0].record(origin)
+        for stream in self.stream_list[1:]:
+            stream.wait_event(self.events[0])
+        func(*args)
+        for stream, event in zip(self.stream_list[1:], self.events[1:]):
+            event.record(stream)
+            origin.wait_event(event)
+        return origin.end_capture()
 
     def _normalize_prob(self):
-        max_exp_p = self.prob.max(0).get()
-        rmax_p = (self.prob.argmax(axis=0) * self.num_proc + self.rank).astype('i4').get()
-        max_exp = np.empty_like(max_exp_p)
-        self.rmax = np.empty_like(rmax_p)
-
-        self.comm.Allreduce([max_exp_p, MPI.DOUBLE], [max_exp, MPI.DOUBLE], op=MPI.MAX)
-        rmax_p[max_exp_p != max_exp] = -1
-        self.comm.Allreduce([rmax_p, MPI.INT], [self.rmax, MPI.INT], op=MPI.MAX)
-        max_exp = cp.array(max_exp)
-
-        self.prob = cp.exp(cp.subtract(self.prob, max_exp, self.prob), self.prob)
-        psum_p = self.prob.sum(0).get()
-        psum = np.empty_like(psum_p)
-        self.comm.Allreduce([psum_p, MPI.DOUBLE], [psum, MPI.DOUBLE], op=MPI.SUM)
-        self.prob = cp.divide(self.prob, cp.array(psum), self.prob)
-        self.prob.clip(a_min=P_MIN, out=self.prob)
-
-    def _update_model(self, views, dmodel, dmweights, drange):
-        p_norm = self.prob.sum(1)
-        h_p_norm = p_norm.get()
+        num_rot_p, ndata = self.prob.shape
+        bsize = int(np.ceil(ndata/32.))
+        stream = cp.cuda.get_current_stream()
+        max_exp_d = cp.empty(ndata, dtype='f4')
+        rmax_d = cp.empty(ndata, dtype='i4')
+        psum_d = cp.empty(ndata, dtype='f8')
+        zero_async(self.p_norm)
+
+        kernels.prob_stats((bsize,), (32,),
+                (self.prob, num_rot_p, ndata, self.rank, self.num_proc, max_exp_d, rmax_d, psum_d))
+        if self.cuda_aware:
+            max_exp = cp.empty_like(max_exp_d)
+            psum = cp.empty_like(psum_d)
+            self.rmax = cp.empty_like(rmax_d)
+            stream.synchronize()
+            self.comm.Allreduce([max_exp_d, MPI.FLOAT], [max_exp, MPI.FLOAT], op=MPI.MAX)
+            rmax_d = cp.where(max_exp_d != max_exp, -1, rmax_d).astype('i4', copy=False)
+            psum_d *= cp.exp(max_exp_d - max_exp)
+            stream.synchronize()
+            self.comm.Allreduce([rmax_d, MPI.INT], [self.rmax, MPI.INT], op=MPI.MAX)
+            self.comm.Allreduce([psum_d, MPI.DOUBLE], [psum, MPI.DOUBLE], op=MPI.SUM)
+        else:
+            max_exp_p = self._pinned('max_exp_p', ndata, 'f4')
+            max_exp = self._pinned('max_exp', ndata, 'f4')
+            rmax_p = self._pinned('rmax_p', ndata, 'i4')
+            self.rmax = self._pinned('rmax', ndata, 'i4')
+            psum_p = self._pinned('psum_p', ndata, 'f8')
+            psum = self._pinned('psum', ndata, 'f8')
+            # Copies into pinned buffers are queued without blocking and share one sync
+            for src, dst in ((max_exp_d, max_exp_p), (rmax_d, rmax_p), (psum_d, psum_p)):
+                src.data.copy_to_host_async(dst.ctypes.data_as(ctypes.c_void_p), dst.nbytes, stream)
+            stream.synchronize()
+
+            self.comm.Allreduce([max_exp_p, MPI.FLOAT], [max_exp, MPI.FLOAT], op=MPI.MAX)
+            rmax_p[max_exp_p != max_exp] = -1
+            self.comm.Allreduce([rmax_p, MPI.INT], [self.rmax, MPI.INT], op=MPI.MAX)
+            psum_p *= np.exp(max_exp_p - max_exp)
+            self.comm.Allreduce([psum_p, MPI.DOUBLE], [psum, MPI.DOUBLE], op=MPI.SUM)
+            max_exp_d.set(max_exp, stream=stream)
+            psum_d.set(psum, stream=stream)
+            max_exp = max_exp_d
+            psum = psum_d
+
+        kernels.prob_norm((int(np.ceil(ndata/256.)),), (256,),
+                (self.prob, num_rot_p, ndata, max_exp, psum, np.float32(P_MIN), self.p_norm))
+
+    def _update_model(self, views, drange):
+        p_norm = self.p_norm
         s = drange[0]
         e = drange[1]
         num_data_b = e - s
 
-        dmodel[:] = 0
-        dmweights[:] = 0
-        for i, r in enumerate(range(self.rank, self.num_rot, self.num_proc)):
-            if h_p_norm[i] == 0.:
-                continue
-            snum = i % self.num_streams
+        self._fork_streams()
+        for snum, batches in enumerate(self.rot_batches):
             self.stream_list[snum].use()
-            views[snum,:] = 0
-            kernels.merge_all((self.bsize_data,), (32,),
-                    (self.prob[i], num_data_b,
-                     self.dset.ones[s:e], self.dset.multi[s:e],
-                     self.dset.ones_accum[s:e], self.dset.multi_accum[s:e],
-                     self.dset.place_ones, self.dset.place_multi, self.dset.count_multi,
-                     views[snum]))
-            views[snum] = views[snum] / p_norm[i] - self.dset.bg
-            kernels.slice_merge((self.bsize_model,)*2, (32,)*2,
-                    (views[snum], r/self.num_rot*2.*np.pi,
-                     self.size, dmodel, dmweights))
-        [s.synchronize() for s in self.stream_list]
-        cp.cuda.Stream().null.use()
-
-    def _normalize_model(self, dmodel, dmweights, iternum):
-        self.model = dmodel.get()
-        self.mweights = dmweights.get()
-        if self.rank == 0:
-            self.comm.Reduce(MPI.IN_PLACE, [self.model, MPI.DOUBLE], root=0, op=MPI.SUM)
-            self.comm.Reduce(MPI.IN_PLACE, [self.mweights, MPI.DOUBLE], root=0, op=MPI.SUM)
-            self.model[self.mweights > 0] /= self.mweights[self.mweights > 0]
+            for r_s, r_e in batches:
+                view = self._stream_views(views, snum, r_e - r_s)
+                zero_async(view, self.stream_list[snum])
+                kernels.merge_all((self.bsize_data, 1, r_e - r_s), (32, 8),
+                        (self.prob[r_s:r_e], self.prob.shape[1], num_data_b,
+                         self.dset.ones[s:e], self.dset.multi[s:e],
+                         self.dset.ones_accum[s:e], self.dset.multi_accum[s:e],
+                         self.dset.place_ones, self.dset.pc_multi,
+                         self.size**2, view))
+                self.slice_merge((self.bsize_model, self.bsize_model, r_e - r_s), (16,)*2,
+                        (view, self.rots[r_s:r_e], p_norm[r_s:r_e], self.dset.bg,
+                         self.size, self.dmodel_acc, self.dmweights))
+        self._join_streams()
+
+    def _stream_views(self, views, snum, num):
+        '''Return the first num views of the batch buffer belonging to stream snum'''
+        start = snum * self.max_batch
+        return views[start:start + num]
+
+    def _pinned(self, name, size, dtype):
+        '''Return cached pinned host buffer, reallocating it if the size or type changed'''
+        buf = self.pinned.get(name)
+        if buf is None or buf.shape != (size,) or buf.dtype != np.dtype(dtype):
+            buf = self.pinned[name] = cupyx.empty_pinned(size, dtype=dtype)
+        return buf
+
+    def _fork_streams(self):
+        '''Make the worker streams wait for all work queued so far on the null stream'''
+        self.fork_event.record(cp.cuda.Stream.null)
+        for stream in self.stream_list:
+            stream.wait_event(self.fork_event)
+
+    def _join_streams(self):
+        '''Make the null stream wait for all work queued on the worker streams
+
+        Events are recorded on each stream so that the host is not blocked. Later work on
+        the null stream is ordered after the queued kernels.
+        '''
+        null_stream = cp.cuda.Stream.null
+        for stream, event in zip(self.stream_list, self.events):
+            event.record(stream)
+            null_stream.wait_event(event)
+        null_stream.use()
+
+    def _normalize_model(self, iternum):
+        dmodel = self.dmodel_acc
+        dmweights = self.dmweights
+        if self.cuda_aware:
+            cp.cuda.get_current_stream().synchronize()
+            self.comm.Allreduce(MPI.IN_PLACE, [dmodel, MPI.DOUBLE], op=MPI.SUM)
+            self.comm.Allreduce(MPI.IN_PLACE, [dmweights, MPI.DOUBLE], op=MPI.SUM)
+            self.dmodel[:] = cp.where(dmweights > 0, dmodel / dmweights, dmodel)
+            if self.rank == 0:
+                self.dmodel.get(out=self.model)
+        else:
+            dmodel.get(out=self.model)
+            dmweights.get(out=self.mweights)
+            if self.rank == 0:
+                self.comm.Reduce(MPI.IN_PLACE, [self.model, MPI.DOUBLE], root=0, op=MPI.SUM)
+                self.comm.Reduce(MPI.IN_PLACE, [self.mweights, MPI.DOUBLE], root=0, op=MPI.SUM)
+                self.model[self.mweights > 0] /= self.mweights[self.mweights > 0]
+            else:
+                self.comm.Reduce([self.model, MPI.DOUBLE], None, root=0, op=MPI.SUM)
+                self.comm.Reduce([self.mweights, MPI.DOUBLE], None, root=0, op=MPI.SUM)
+            self.comm.Bcast([self.model, MPI.DOUBLE], root=0)
+
+            # Upload on the copy stream so that saving the model below overlaps with it.
+            # Later work on the null stream waits for the upload
+            null_stream = cp.cuda.Stream.null
+            self.fork_event.record(null_stream)
+            self.copy_stream.wait_event(self.fork_event)
+            self.dmodel.set(self.model, stream=self.copy_stream)
+            self.copy_event.record(self.copy_stream)
+            null_stream.wait_event(self.copy_event)
 
+        if self.rank == 0:
             if iternum is None:
                 np.save('data/model.npy', self.model)
             else:
                 np.save('data/model_%.3d.npy'%iternum, self.model)
-                np.save('data/rmax_%.3d.npy'%iternum, self.rmax/self.num_rot*360.)
-        else:
-            self.comm.Reduce([self.model, MPI.DOUBLE], None, root=0, op=MPI.SUM)
-            self.comm.Reduce([self.mweights, MPI.DOUBLE], None, root=0, op=MPI.SUM)
-        self.comm.Bcast([self.model, MPI.DOUBLE], root=0)
+                np.save('data/rmax_%.3d.npy'%iternum, cp.asnumpy(self.rmax)/self.num_rot*360.)
 
 def main():
     '''Parses command line arguments and launches EMC reconstruction'''
@@ -258,6 +421,8 @@ def main():
                         help='Path to devices file')
     parser.add_argument('-s', '--streams', type=int, default=4,
                         help='Number of streams to use (default=4)')
+    parser.add_argument('-g', '--cuda_aware', action='store_true', default=False,
+                        help='Reduce GPU buffers directly with CUDA-aware MPI')
     args = parser.parse_args()
 
     comm = MPI.COMM_WORLD
@@ -276,19 +441,19 @@ def main():
             sys.stdout.flush()
             cp.cuda.Device(dev).use()
 
-    recon = EMC(args.config_file, num_streams=args.streams)
+    recon = EMC(args.config_file, num_streams=args.streams, cuda_aware=args.cuda_aware)
     if rank == 0:
         print('\nIter  time(s)  change')
         sys.stdout.flush()
         avgtime = 0.
         numavg = 0
     for i in range(args.num_iter):
-        m0 = cp.array(recon.model)
+        m0 = recon.dmodel.copy()
         stime = time.time()
         recon.run_iteration(i+1)
         etime = time.time()
         if rank == 0:
-            norm = float(cp.linalg.norm(cp.array(recon.model) - m0))
+            norm = float(cp.linalg.norm(recon.dmodel - m0))
             print('%-6d%-.2e %e' % (i+1, etime-stime, norm))
             sys.stdout.flush()
             if i > 0:
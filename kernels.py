@@ -1,135 +1,341 @@
 import cupy as cp
 
-slice_gen = cp.RawKernel(r'''
+OPTIONS = ('--use_fast_math',)
+
+def specialize(kernel, size):
+    '''Return copy of kernel compiled with the model size fixed at compile time
+
+    Only affects kernels which read the size through the MODEL_SIZE macro.
+    '''
+    return cp.RawKernel(kernel.code, kernel.name, options=kernel.options + ('-DMODEL_SIZE=%d' % size,))
+
+# Shared by slice_gen and slice_merge, which must use the same 16x16 block shape
+TILE = r'''
+    #ifndef MODEL_SIZE
+    #define MODEL_SIZE size_arg
+    #endif
+    // Side of the shared model tile. Must exceed the bounding box of a rotated
+    // 16x16 thread block ((16-1)*sqrt(2) + 3 voxels)
+    #define TDIM 26
+
+    // Tile origin from the lowest rotated corner of this block
+    __device__ void tile_origin(const double *rot, const int cen, int *ox, int *oy) {
+        int x0 = (int) (blockIdx.x * blockDim.x) - cen, x1 = x0 + (int) blockDim.x - 1 ;
+        int y0 = (int) (blockIdx.y * blockDim.y) - cen, y1 = y0 + (int) blockDim.y - 1 ;
+        *ox = __double2int_rd(fmin(fmin(rot[0] * x0 + rot[1] * y0, rot[0] * x1 + rot[1] * y0),
+                                   fmin(rot[0] * x0 + rot[1] * y1, rot[0] * x1 + rot[1] * y1)) + cen) ;
+        *oy = __double2int_rd(fmin(fmin(rot[2] * x0 + rot[3] * y0, rot[2] * x1 + rot[3] * y0),
+                                   fmin(rot[2] * x0 + rot[3] * y1, rot[2] * x1 + rot[3] * y1)) + cen) ;
+    }
+'''
+
+slice_gen = cp.RawKernel(TILE + r'''
     extern "C" __global__
     void slice_gen(const double *model,
-                   const double angle,
+                   const double *rots,
                    const double scale,
-                   const long long size,
-                   const double *bg,
+                   const long long size_arg,
+                   const float *bg,
                    const long long log_flag,
-                   double *view) {
+                   float *views) {
+        __shared__ double s_model[TDIM*TDIM] ;
+        const long long size = MODEL_SIZE ;
         int x = blockIdx.x * blockDim.x + threadIdx.x ;
         int y = blockIdx.y * blockDim.y + threadIdx.y ;
+        int tid = threadIdx.y * blockDim.x + threadIdx.x ;
+        int nthreads = blockDim.x * blockDim.y ;
+        int i, mx, my ;
+
+        int cen = size / 2 ;
+        const double *rot = &rots[4*blockIdx.z] ;
+
+        int ox, oy ;
+        tile_origin(rot, cen, &ox, &oy) ;
+        for (i = tid ; i < TDIM*TDIM ; i += nthreads) {
+            mx = ox + i / TDIM ;
+            my = oy + i % TDIM ;
+            if (mx >= 0 && mx < size && my >= 0 && my < size)
+                s_model[i] = model[mx*size + my] ;
+        }
+        __syncthreads() ;
+
         if (x > size - 1 || y > size - 1)
             return ;
         int t = x*size + y ;
+        float *view = &views[blockIdx.z * size * size] ;
         if (log_flag)
-            view[t] = -1000. ;
+            view[t] = -1000.f ;
         else
-            view[t] = 0. ;
+            view[t] = 0.f ;
 
-        int cen = size / 2 ;
-        double ac = cos(angle), as = sin(angle) ;
-        double tx = (x - cen) * ac - (y - cen) * as + cen ;
-        double ty = (x - cen) * as + (y - cen) * ac + cen ;
+        double tx = rot[0] * (x - cen) + rot[1] * (y - cen) + cen ;
+        double ty = rot[2] * (x - cen) + rot[3] * (y - cen) + cen ;
         int ix = __double2int_rd(tx), iy = __double2int_rd(ty) ;
         if (ix < 0 || ix > size - 2 || iy < 0 || iy > size - 2)
             return ;
 
         double fx = tx - ix, fy = ty - iy ;
         double cx = 1. - fx, cy = 1. - fy ;
+        int lx = ix - ox, ly = iy - oy ;
 
-        view[t] = model[ix*size + iy]*cx*cy + 
+        float val ;
+        if (lx >= 0 && lx < TDIM - 1 && ly >= 0 && ly < TDIM - 1)
+            val = s_model[lx*TDIM + ly]*cx*cy +
+                  s_model[(lx+1)*TDIM + ly]*fx*cy +
+                  s_model[lx*TDIM + (ly+1)]*cx*fy +
+                  s_model[(lx+1)*TDIM + (ly+1)]*fx*fy ;
+        else
+            val = model[ix*size + iy]*cx*cy + 
                   model[(ix+1)*size + iy]*fx*cy +
                   model[ix*size + (iy+1)]*cx*fy + 
                   model[(ix+1)*size + (iy+1)]*fx*fy ;
-        view[t] *= scale ;
-        view[t] += bg[t] ;
+        val = val * scale + bg[t] ;
         if (log_flag) {
-            if (view[t] < 1.e-20)
-                view[t] = -1000. ;
+            if (val < 1.e-20f)
+                val = -1000.f ;
             else
-                view[t] = log(view[t]) ;
+                val = logf(val) ;
         }
+        view[t] = val ;
     }
-    ''', 'slice_gen')
+    ''', 'slice_gen', options=OPTIONS)
 
-slice_merge = cp.RawKernel(r'''
+slice_merge = cp.RawKernel(TILE + r'''
     extern "C" __global__
-    void slice_merge(const double *view,
-                     const double angle,
-                     const long long size,
+    void slice_merge(const float *views,
+                     const double *rots,
+                     const double *p_norm,
+                     const float *bg,
+                     const long long size_arg,
                      double *model,
                      double *mweights) {
+        __shared__ double s_model[TDIM*TDIM], s_weights[TDIM*TDIM] ;
+        const long long size = MODEL_SIZE ;
         int x = blockIdx.x * blockDim.x + threadIdx.x ;
         int y = blockIdx.y * blockDim.y + threadIdx.y ;
-        if (x > size - 1 || y > size - 1)
-            return ;
-        int t = x*size + y ;
+        int tid = threadIdx.y * blockDim.x + threadIdx.x ;
+        int nthreads = blockDim.x * blockDim.y ;
+        int i, mx, my ;
+        for (i = tid ; i < TDIM*TDIM ; i += nthreads) {
+            s_model[i] = 0. ;
+            s_weights[i] = 0. ;
+        }
 
         int cen = size / 2 ;
-        double ac = cos(angle), as = sin(angle) ;
-        double tx = (x - cen) * ac - (y - cen) * as + cen ;
-        double ty = (x - cen) * as + (y - cen) * ac + cen ;
-        int ix = __double2int_rd(tx), iy = __double2int_rd(ty) ;
-        if (ix < 0 || ix > size - 2 || iy < 0 || iy > size - 2)
-            return ;
-        double fx = tx - ix, fy = ty - iy ;
-        double cx = 1. - fx, cy = 1. - fy ;
+        const double *rot = &rots[4*blockIdx.z] ;
+
+        int ox, oy ;
+        tile_origin(rot, cen, &ox, &oy) ;
+        __syncthreads() ;
+
+        if (x < size && y < size) {
+            int t = x*size + y ;
+            const float *view = &views[blockIdx.z * size * size] ;
+            double tx = rot[0] * (x - cen) + rot[1] * (y - cen) + cen ;
+            double ty = rot[2] * (x - cen) + rot[3] * (y - cen) + cen ;
+            int ix = __double2int_rd(tx), iy = __double2int_rd(ty) ;
+            if (ix >= 0 && ix <= size - 2 && iy >= 0 && iy <= size - 2) {
+                double fx = tx - ix, fy = ty - iy ;
+                double cx = 1. - fx, cy = 1. - fy ;
+                double val = view[t] / p_norm[blockIdx.z] - bg[t] ;
+                int lx = ix - ox, ly = iy - oy ;
 
-        atomicAdd(&model[ix*size + iy], view[t]*cx*cy) ;
-        atomicAdd(&mweights[ix*size + iy], cx*cy) ;
+                if (lx >= 0 && lx < TDIM - 1 && ly >= 0 && ly < TDIM - 1) {
+                    atomicAdd(&s_model[lx*TDIM + ly], val*cx*cy) ;
+                    atomicAdd(&s_weights[lx*TDIM + ly], cx*cy) ;
 
-        atomicAdd(&model[(ix+1)*size + iy], view[t]*fx*cy) ;
-        atomicAdd(&mweights[(ix+1)*size + iy], fx*cy) ;
+                    atomicAdd(&s_model[(lx+1)*TDIM + ly], val*fx*cy) ;
+                    atomicAdd(&s_weights[(lx+1)*TDIM + ly], fx*cy) ;
 
-        atomicAdd(&model[ix*size + (iy+1)], view[t]*cx*fy) ;
-        atomicAdd(&mweights[ix*size + (iy+1)], cx*fy) ;
+                    atomicAdd(&s_model[lx*TDIM + (ly+1)], val*cx*fy) ;
+                    atomicAdd(&s_weights[lx*TDIM + (ly+1)], cx*fy) ;
 
-        atomicAdd(&model[(ix+1)*size + (iy+1)], view[t]*fx*fy) ;
-        atomicAdd(&mweights[(ix+1)*size + (iy+1)], fx*fy) ;
+                    atomicAdd(&s_model[(lx+1)*TDIM + (ly+1)], val*fx*fy) ;
+                    atomicAdd(&s_weights[(lx+1)*TDIM + (ly+1)], fx*fy) ;
+                }
+                else {
+                    atomicAdd(&model[ix*size + iy], val*cx*cy) ;
+                    atomicAdd(&mweights[ix*size + iy], cx*cy) ;
+
+                    atomicAdd(&model[(ix+1)*size + iy], val*fx*cy) ;
+                    atomicAdd(&mweights[(ix+1)*size + iy], fx*cy) ;
+
+                    atomicAdd(&model[ix*size + (iy+1)], val*cx*fy) ;
+                    atomicAdd(&mweights[ix*size + (iy+1)], cx*fy) ;
+
+                    atomicAdd(&model[(ix+1)*size + (iy+1)], val*fx*fy) ;
+                    atomicAdd(&mweights[(ix+1)*size + (iy+1)], fx*fy) ;
+                }
+            }
+        }
+        __syncthreads() ;
+
+        // One global update per touched voxel of the tile
+        for (i = tid ; i < TDIM*TDIM ; i += nthreads) {
+            if (s_weights[i] == 0.)
+                continue ;
+            mx = ox + i / TDIM ;
+            my = oy + i % TDIM ;
+            atomicAdd(&model[mx*size + my], s_model[i]) ;
+            atomicAdd(&mweights[mx*size + my], s_weights[i]) ;
+        }
     }
-    ''', 'slice_merge')
+    ''', 'slice_merge', options=OPTIONS)
 
 calc_prob_all = cp.RawKernel(r'''
     extern "C" __global__
-    void calc_prob_all(const double *lview,
+    void calc_prob_all(const float *__restrict__ views,
+                       const long long npix,
                        const long long ndata,
-                       const int *ones,
-                       const int *multi,
-                       const long long *o_acc,
-                       const long long *m_acc,
-                       const int *p_o,
-                       const int *p_m,
-                       const int *c_m,
-                       const double init,
-                       const double *scales,
-                       double *prob_r) {
-        long long d, t ;
-        d = blockDim.x * blockIdx.x + threadIdx.x ;
+                       const int *__restrict__ ones,
+                       const int *__restrict__ multi,
+                       const long long *__restrict__ o_acc,
+                       const long long *__restrict__ m_acc,
+                       const int *__restrict__ p_o,
+                       const int2 *__restrict__ pc_m,
+                       const double *__restrict__ init,
+                       const double *__restrict__ scales,
+                       const long long prob_stride,
+                       float *__restrict__ prob) {
+        // One warp (threadIdx.x) per frame (threadIdx.y)
+        long long d, t, t_end ;
+        int offset ;
+        d = blockDim.y * blockIdx.x + threadIdx.y ;
         if (d >= ndata)
             return ;
+        const float *lview = &views[blockIdx.z * npix] ;
+        int2 pc ;
 
-        prob_r[d] = init * scales[d] ;
-        for (t = o_acc[d] ; t < o_acc[d] + ones[d] ; ++t)
-            prob_r[d] += lview[p_o[t]] ;
-        for (t = m_acc[d] ; t < m_acc[d] + multi[d] ; ++t)
-            prob_r[d] += lview[p_m[t]] * c_m[t] ;
+        float val = 0.f ;
+        t_end = o_acc[d] + ones[d] ;
+        for (t = o_acc[d] + threadIdx.x ; t < t_end ; t += 32)
+            val += __ldg(&lview[__ldg(&p_o[t])]) ;
+        t_end = m_acc[d] + multi[d] ;
+        for (t = m_acc[d] + threadIdx.x ; t < t_end ; t += 32) {
+            pc = __ldg(&pc_m[t]) ;
+            val += __ldg(&lview[pc.x]) * pc.y ;
+        }
+        for (offset = 16 ; offset > 0 ; offset /= 2)
+            val += __shfl_xor_sync(0xffffffff, val, offset) ;
+        if (threadIdx.x == 0)
+            prob[blockIdx.z * prob_stride + d] = init[0] * scales[d] + val ;
     }
-    ''', 'calc_prob_all')
+    ''', 'calc_prob_all', options=OPTIONS)
 
 merge_all = cp.RawKernel(r'''
     extern "C" __global__
-    void merge_all(const double *prob_r,
+    void merge_all(const float *__restrict__ prob,
+                   const long long prob_stride,
                    const long long ndata,
-                   const int *ones,
-                   const int *multi,
-                   const long long *o_acc,
-                   const long long *m_acc,
-                   const int *p_o,
-                   const int *p_m,
-                   const int *c_m,
-                   double *view) {
-        long long d, t ;
+                   const int *__restrict__ ones,
+                   const int *__restrict__ multi,
+                   const long long *__restrict__ o_acc,
+                   const long long *__restrict__ m_acc,
+                   const int *__restrict__ p_o,
+                   const int2 *__restrict__ pc_m,
+                   const long long npix,
+                   float *__restrict__ views) {
+        // One warp (threadIdx.x) per frame (threadIdx.y)
+        long long d, t, t_end ;
+        d = blockDim.y * blockIdx.x + threadIdx.y ;
+        if (d >= ndata)
+            return ;
+        float prob_r = prob[blockIdx.z * prob_stride + d] ;
+        float *view = &views[blockIdx.z * npix] ;
+        int2 pc ;
+
+        t_end = o_acc[d] + ones[d] ;
+        for (t = o_acc[d] + threadIdx.x ; t < t_end ; t += 32)
+            atomicAdd(&view[__ldg(&p_o[t])], prob_r) ;
+        t_end = m_acc[d] + multi[d] ;
+        for (t = m_acc[d] + threadIdx.x ; t < t_end ; t += 32) {
+            pc = __ldg(&pc_m[t]) ;
+            atomicAdd(&view[pc.x], prob_r * pc.y) ;
+        }
+    }
+    ''', 'merge_all', options=OPTIONS)
+
+prob_stats = cp.RawKernel(r'''
+    extern "C" __global__
+    void prob_stats(const float *prob,
+                    const long long nrot,
+                    const long long ndata,
+                    const long long rank,
+                    const long long num_proc,
+                    float *max_exp,
+                    int *rmax,
+                    double *psum) {
+        long long d, r ;
         d = blockDim.x * blockIdx.x + threadIdx.x ;
         if (d >= ndata)
             return ;
 
-        for (t = o_acc[d] ; t < o_acc[d] + ones[d] ; ++t)
-            atomicAdd(&view[p_o[t]], prob_r[d]) ;
-        for (t = m_acc[d] ; t < m_acc[d] + multi[d] ; ++t)
-            atomicAdd(&view[p_m[t]], prob_r[d] * c_m[t]) ;
+        // Running maximum with the sum of exponentials rescaled whenever it changes
+        float val, pmax = prob[d] ;
+        double sum = 1. ;
+        long long rm = 0 ;
+        for (r = 1 ; r < nrot ; ++r) {
+            val = prob[r*ndata + d] ;
+            if (val > pmax) {
+                sum = sum * expf(pmax - val) + 1. ;
+                pmax = val ;
+                rm = r ;
+            }
+            else {
+                sum += expf(val - pmax) ;
+            }
+        }
+        max_exp[d] = pmax ;
+        rmax[d] = rm * num_proc + rank ;
+        psum[d] = sum ;
     }
-    ''', 'merge_all')
+    ''', 'prob_stats', options=OPTIONS)
+
+prob_norm = cp.RawKernel(r'''
+    extern "C" __global__
+    void prob_norm(float *prob,
+                   const long long nrot,
+                   const long long ndata,
+                   const float *max_exp,
+                   const double *psum,
+                   const float p_min,
+                   double *p_norm) {
+        // Launched with blockDim.x a multiple of 32. p_norm must be zeroed beforehand.
+        // Warp partials are summed in shared memory, giving one atomic per block and
+        // rotation. Partials alternate between two buffers so one barrier per rotation suffices
+        __shared__ double s_sum[2][32] ;
+        long long d, i, r ;
+        int offset, lane = threadIdx.x % 32, warp = threadIdx.x / 32 ;
+        d = blockDim.x * blockIdx.x + threadIdx.x ;
+
+        float val, pmax = 0.f, norm = 0.f ;
+        double rsum ;
+        if (d < ndata) {
+            pmax = max_exp[d] ;
+            norm = 1. / psum[d] ;
+        }
+        for (i = 0 ; i < nrot ; ++i) {
+            // Blocks start at different rotations to spread atomics over addresses
+            r = (i + blockIdx.x) % nrot ;
+            val = 0.f ;
+            if (d < ndata) {
+                val = fmaxf(expf(prob[r*ndata + d] - pmax) * norm, p_min) ;
+                prob[r*ndata + d] = val ;
+            }
+            rsum = val ;
+            for (offset = 16 ; offset > 0 ; offset /= 2)
+                rsum += __shfl_down_sync(0xffffffff, rsum, offset) ;
+            if (lane == 0)
+                s_sum[i % 2][warp] = rsum ;
+            __syncthreads() ;
 
+            if (warp == 0) {
+                rsum = lane < blockDim.x / 32 ? s_sum[i % 2][lane] : 0. ;
+                for (offset = 16 ; offset > 0 ; offset /= 2)
+                    rsum += __shfl_down_sync(0xffffffff, rsum, offset) ;
+                if (lane == 0)
+                    atomicAdd(&p_norm[r], rsum) ;
+            }
+        }
+    }
+    ''', 'prob_norm', options=OPTIONS)
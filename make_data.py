@@ -126,12 +126,14 @@ class DataGenerator():
             else:
                 scale = np.ones(self.num_data, dtype='f8')
             
-            rot_mask = cp.empty(self.size**2, dtype='f8')
-            bsize_model = int(np.ceil(self.size/32.))
+            rot_mask = cp.empty(self.size**2, dtype='f4')
+            bgmask = self.bgmask.astype('f4')
+            rots = cp.array(np.stack((np.cos(ang), -np.sin(ang), np.sin(ang), np.cos(ang)), axis=1))
+            bsize_model = int(np.ceil(self.size/16.))
             stime = time.time()
             for i in range(self.num_data):
-                kernels.slice_gen((bsize_model,)*2, (32,)*2,
-                    (self.mask, ang[i], scale[i], self.size, self.bgmask, 0, rot_mask))
+                kernels.slice_gen((bsize_model,)*2, (16,)*2,
+                    (self.mask, rots[i], scale[i], self.size, bgmask, 0, rot_mask))
                 frame = cp.random.poisson(rot_mask, dtype='i4').ravel()
                 place_ones[i] = cp.where(frame == 1)[0].get()
                 place_multi[i] = cp.where(frame > 1)[0].get()